@@ -1,17 +1,43 @@
 import streamlit as st
+import html
+import itertools
 import random
-from datetime import datetime
-from openai import OpenAI  # 최신 OpenAI 인터페이스
+import time
+from datetime import date
+
+# 고정 데이터 (모듈 로드 시 한 번만 생성, rerun마다 재할당하지 않음)
+# Tip: 외부 API 대신 고퀄리티 명언 리스트 활용 (속도와 안정성 위해)
+QUOTES = (
+    ("작은 반복이 거대한 차이를 만든다.", "제임스 클리어"),
+    ("우리는 우리가 반복적으로 하는 일의 결과물이다.", "아리스토텔레스"),
+    ("동기부여는 시작하게 하고, 습관은 계속하게 한다.", "짐 론"),
+    ("자신을 이기는 자가 가장 강한 자다.", "노자"),
+)
+QUOTE_HTML = tuple(
+    f'<div class="quote-box"><div class="quote-text">{html.escape(q)}</div>'
+    f'<div class="quote-author">— {html.escape(a)}</div></div>'
+    for q, a in QUOTES
+)
+RECOMMENDATIONS = ("10분 스트레칭", "디지털 디톡스", "감사 일기 쓰기", "외국어 단어 5개 암기")
+# 습관 체크리스트 열 개수 (centered 레이아웃에서 한글 습관명이 줄바꿈되지 않는 폭)
+HABIT_COLUMNS = 2
+# Tarot API 시뮬레이션 (공용 API는 불안정한 경우가 많아 78장 로직 내장 권장)
+TAROT_CARDS = ("The Fool", "The Magician", "The High Priestess", "The Empress", "The Lovers", "Strength")
+CARD_IMAGE_URLS = {
+    card: f"https://www.trustedtarot.com/img/cards/{card.lower().replace(' ', '-')}.png"
+    for card in TAROT_CARDS
+}
 
 # 1. 페이지 설정
 st.set_page_config(page_title="Habit Tracker", page_icon="🍏", layout="centered")
 
 # 2. iOS 스타일 CSS 인젝션
-def local_css():
-    st.markdown("""
+# 폰트는 @import 대신 <link>로 받아 CSS 파싱과 병렬로 로드 (SF Pro는 Google Fonts에 없어 Inter만 요청)
+IOS_CSS = """
+        <link rel="preconnect" href="https://fonts.googleapis.com">
+        <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
+        <link rel="stylesheet" href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600&display=swap">
         <style>
-        @import url('https://fonts.googleapis.com/css2?family=SF+Pro+Display:wght@300;400;600&family=Inter:wght@400;600&display=swap');
-
         /* 배경 설정 */
         .stApp { background-color: #F2F2F7; }
         
@@ -41,7 +67,7 @@ def local_css():
         }
 
         /* 입력창 & 버튼 */
-        div.stButton > button {
+        div.stButton > button, div.stFormSubmitButton > button {
             border-radius: 12px;
             background-color: #007AFF;
             color: white;
@@ -59,17 +85,21 @@ def local_css():
             backdrop-filter: blur(20px);
         }
         </style>
-    """, unsafe_allow_html=True)
+"""
+
+def local_css():
+    st.markdown(IOS_CSS, unsafe_allow_html=True)
 
 local_css()
 
-# 3. 세션 상태 관리
-if 'user_info' not in st.session_state:
+# 3. 세션 상태 관리 (세션당 한 번만 초기화)
+if 'session_ready' not in st.session_state:
     st.session_state.user_info = None
-if 'habits' not in st.session_state:
     st.session_state.habits = ["물 2L 마시기", "아침 명상", "영양제 먹기"]
-if 'habit_status' not in st.session_state:
-    st.session_state.habit_status = {h: False for h in st.session_state.habits}
+    st.session_state.ai_cache = {}
+    st.session_state.analysis_result = None
+    st.session_state.rng = random.Random()  # 타로 카드 뽑기용 세션 RNG
+    st.session_state.session_ready = True
 
 # 4. 사용자 온보딩 (이름, 나이, 성별 입력)
 if st.session_state.user_info is None:
@@ -98,106 +128,235 @@ with st.sidebar:
     st.divider()
     if st.button("데이터 초기화"):
         st.session_state.user_info = None
+        st.session_state.analysis_result = None
         st.rerun()
 
+# 오늘의 명언/추천은 (사용자, 날짜)로 고정 → 하루 동안 같은 결과를 캐시에서 반환
+@st.cache_data(ttl=86400, show_spinner=False)
+def todays_quote(user, day):
+    return random.Random(f"quote:{user}:{day}").choice(QUOTE_HTML)
+
+# 추천은 (사용자, 날짜)로 섞은 순서를 고정하고, 이미 추가한 습관은 건너뜀
+@st.cache_data(ttl=86400, show_spinner=False)
+def todays_rec_order(user, day):
+    return tuple(random.Random(f"rec:{user}:{day}").sample(RECOMMENDATIONS, len(RECOMMENDATIONS)))
+
+def todays_rec(user, day, habits):
+    return next((r for r in todays_rec_order(user, day) if r not in habits), None)
+
+today = date.today().isoformat()
+
 # 6. 상단 명언 섹션 (깔끔한 애플 스타일)
-# Tip: 외부 API 대신 고퀄리티 명언 리스트 활용 (속도와 안정성 위해)
-quotes = [
-    {"q": "작은 반복이 거대한 차이를 만든다.", "a": "제임스 클리어"},
-    {"q": "우리는 우리가 반복적으로 하는 일의 결과물이다.", "a": "아리스토텔레스"},
-    {"q": "동기부여는 시작하게 하고, 습관은 계속하게 한다.", "a": "짐 론"},
-    {"q": "자신을 이기는 자가 가장 강한 자다.", "a": "노자"}
-]
-selected_q = random.choice(quotes)
-st.markdown(f"""
-    <div class="quote-box">
-        <div class="quote-text">{selected_q['q']}</div>
-        <div class="quote-author">— {selected_q['a']}</div>
-    </div>
-""", unsafe_allow_html=True)
+st.markdown(todays_quote(st.session_state.user_info['name'], today), unsafe_allow_html=True)
 
 # 7. 메인 헤더
 st.title(f"{st.session_state.user_info['name']}님의 오늘")
 
 # 8. Daily Habits (습관 추가 기능 포함)
-st.subheader("✅ Daily Habits")
-
-# 습관 추가 영역
-new_habit = st.text_input("새로운 습관 추가", placeholder="예: 매일 만보 걷기", label_visibility="collapsed")
-if st.button("추가"):
-    if new_habit and new_habit not in st.session_state.habits:
-        st.session_state.habits.append(new_habit)
-        st.session_state.habit_status[new_habit] = False
-        st.rerun()
+# 체크 시 이 블록만 다시 실행 (CSS, 명언, AI 결과 등 나머지 페이지는 rerun하지 않음)
+@st.fragment
+def habits_block():
+    st.subheader("✅ Daily Habits")
 
-# 습관 리스트 출력
-completed_count = 0
-for habit in st.session_state.habits:
-    is_checked = st.checkbox(habit, key=habit, value=st.session_state.habit_status.get(habit, False))
-    st.session_state.habit_status[habit] = is_checked
-    if is_checked:
-        completed_count += 1
+    # 습관 추가 영역 (폼으로 묶어 제출 시에만 rerun)
+    # 추가는 블록 밖의 추천 영역도 바꾸므로 전체 rerun으로 다시 그림 (체크만 fragment rerun)
+    with st.form("add_habit", clear_on_submit=True):
+        new_habit = st.text_input("새로운 습관 추가", placeholder="예: 매일 만보 걷기", label_visibility="collapsed")
+        add_submitted = st.form_submit_button("추가")
+    if add_submitted and new_habit and new_habit not in st.session_state.habits:
+        st.session_state.habits = [*st.session_state.habits, new_habit]
+        st.rerun(scope="app")
 
-# 진척도
-progress = completed_count / len(st.session_state.habits) if st.session_state.habits else 0
-st.progress(progress)
+    # 습관 리스트 출력 (체크 상태는 위젯 key로 유지, 별도 상태 dict 없음)
+    habits = st.session_state.habits
+    cols = st.columns(HABIT_COLUMNS)
+    checked = [cols[i % HABIT_COLUMNS].checkbox(habit, key=f"hb::{habit}") for i, habit in enumerate(habits)]
+    completed_count = sum(checked)
+
+    # 진척도 (정수 퍼센트, 반올림)
+    total_count = len(checked)
+    progress = (100 * completed_count + total_count // 2) // total_count if total_count else 0
+    st.progress(progress)
+    st.session_state.habit_progress = progress  # 전체 rerun(AI 코칭 제출) 시 프롬프트에서 사용
+
+habits_block()
+progress = st.session_state.habit_progress
 
 # 습관 추천 기능 (간단한 로직 또는 AI 활용 가능)
+# 버튼은 화면에 보인 추천에 묶어 둠 (클릭 rerun에서 추천을 다시 계산해 다른 습관이 추가되지 않도록)
+def add_recommended_habit(habit):
+    if habit not in st.session_state.habits:
+        st.session_state.habits = [*st.session_state.habits, habit]
+
 with st.expander("💡 추천 습관 보기"):
-    recommendations = ["10분 스트레칭", "디지털 디톡스", "감사 일기 쓰기", "외국어 단어 5개 암기"]
-    rec_habit = random.choice(recommendations)
-    st.write(f"오늘은 **[{rec_habit}]** 어떠신가요?")
-    if st.button("이 습관 추가하기"):
-        if rec_habit not in st.session_state.habits:
-            st.session_state.habits.append(rec_habit)
-            st.rerun()
+    rec_habit = todays_rec(st.session_state.user_info['name'], today, st.session_state.habits)
+    if rec_habit is None:
+        st.write("추천 습관을 모두 추가했어요. 멋져요!")
+    else:
+        st.write(f"오늘은 **[{rec_habit}]** 어떠신가요?")
+        st.button("이 습관 추가하기", key=f"rec::{rec_habit}", on_click=add_recommended_habit, args=(rec_habit,))
 
 # 9. Today's Reflection
 st.subheader("📝 Today's Reflection")
-reflection = st.text_area("오늘의 생각이나 기분을 기록해보세요.", placeholder="여기에 작성...", height=100)
+with st.form("reflection"):
+    reflection = st.text_area("오늘의 생각이나 기분을 기록해보세요.", placeholder="여기에 작성...", height=100)
+    coach_requested = st.form_submit_button("🔮 AI 코칭 및 타로 결과 보기")
 
 # 10. 타로 및 AI 분석 (API 연동)
-if st.button("🔮 AI 코칭 및 타로 결과 보기"):
+# AI 응답 캐시 유효 시간 (초)
+AI_CACHE_TTL = 3600
+AI_CACHE_MAX_ENTRIES = 20
+# 프롬프트/응답 길이 상한 (토큰 수가 곧 지연시간과 비용)
+REFLECTION_MAX_CHARS = 400
+COACH_MAX_TOKENS = 300
+# 고정 지시문은 system 메시지 앞부분에 두어 매 요청 동일한 prefix 유지
+COACH_SYSTEM_PROMPT = "\n".join([
+    "당신은 iOS 감성의 따뜻하고 세련된 라이프 코치입니다.",
+    "1. 타로 카드의 의미를 오늘 하루와 연결해줘.",
+    "2. 칭찬과 함께 내일 더 잘할 수 있는 다정한 조언을 해줘.",
+    "3. 아주 심플하고 간결하게 애플 스타일로 답변해줘.",
+    "각 항목은 2문장 이내, 전체 200자 이내로 문장을 끝맺어줘.",
+])
+
+# OpenAI 클라이언트는 API 키별로 한 번만 생성 (내부 HTTP 커넥션 풀을 rerun 간 재사용)
+# 프로세스 전역 캐시이므로 개수/수명을 제한해 입력된 키와 클라이언트가 서버에 계속 남지 않도록 함
+@st.cache_resource(max_entries=8, ttl=3600)
+def get_openai_client(api_key):
+    from openai import OpenAI  # 최신 OpenAI 인터페이스 (AI 기능을 쓸 때만 import)
+
+    # 기본 타임아웃(600초) 대신 짧게 끊고, 일시적 오류는 SDK가 재시도
+    return OpenAI(api_key=api_key, timeout=30.0, max_retries=2)
+
+# 타로 카드 이미지는 서버에서 한 번 받아 캐시 (매 렌더마다 외부 CDN 핫링크하지 않도록)
+# 성공한 이미지는 하루 동안 보관, 실패는 예외로 올려 이 캐시에는 남기지 않음
+@st.cache_data(ttl=86400, max_entries=len(TAROT_CARDS), show_spinner=False)
+def fetch_card_image(url):
+    import requests
+
+    r = requests.get(url, timeout=5)
+    r.raise_for_status()
+    return r.content
+
+# 실패 시 원본 URL을 짧게(CARD_RETRY_TTL)만 캐시 → CDN 장애 동안 rerun마다 타임아웃을 기다리지 않고,
+# 일시적 오류가 지나면 곧 다시 서버에서 받아 옴 (성공 시에는 위의 하루짜리 캐시에서 바로 반환)
+CARD_RETRY_TTL = 300
+
+@st.cache_data(ttl=CARD_RETRY_TTL, max_entries=len(TAROT_CARDS), show_spinner=False)
+def card_image(card_drawn):
+    import requests
+
+    url = CARD_IMAGE_URLS[card_drawn]
+    try:
+        return fetch_card_image(url)
+    except requests.RequestException:
+        return url
+
+# 캐시에 쓸 때 만료 항목을 정리하고, 개수 상한을 넘으면 가장 오래된 항목부터 제거
+def remember_coaching(cache_key, text):
+    now = time.time()
+    cache = {k: v for k, v in st.session_state.ai_cache.items() if now - v[0] <= AI_CACHE_TTL}
+    cache[cache_key] = (now, text)
+    while len(cache) > AI_CACHE_MAX_ENTRIES:
+        del cache[next(iter(cache))]
+    st.session_state.ai_cache = cache
+
+# 응답을 토큰 단위로 흘려보내 첫 글자부터 바로 표시 (종료 사유는 status에 기록)
+def stream_coaching(client, model, system, user, status):
+    stream = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system},
+            {"role": "user", "content": user}
+        ],
+        max_tokens=COACH_MAX_TOKENS,
+        temperature=0.7,
+        stream=True
+    )
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        if chunk.choices[0].finish_reason:
+            status["finish_reason"] = chunk.choices[0].finish_reason
+        if chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+# 사용자 프롬프트는 한 번의 join으로 구성 (들여쓰기 공백이 토큰으로 나가지 않도록)
+def build_coach_prompt(user_info, progress, reflection, card_drawn):
+    profile = f"{user_info['name']}, {user_info['age']}세"
+    if user_info["gender"] != "선택하지 않음":
+        profile += f", {user_info['gender']}"
+    return "\n".join([
+        f"사용자: {profile}",
+        f"습관 달성률: {progress}%",
+        f"오늘의 일기: {reflection[:REFLECTION_MAX_CHARS]}",
+        f"뽑은 타로 카드: {card_drawn}",
+    ])
+
+# 결과 출력 레이아웃 (타로/AI 코치 칼럼을 돌려줌, 카드 이미지는 호출 측에서 응답 이후 채움)
+def show_analysis(card_drawn):
+    st.divider()
+    c1, c2 = st.columns([1, 2])
+    c1.markdown(f"### 🃏 Tarot\n**{card_drawn}**")
+    c2.markdown("### 🕊️ AI Coach")
+    return c1, c2
+
+if coach_requested:
     if not api_key:
         st.info("사이드바에 OpenAI API Key를 입력하면 AI 분석을 받을 수 있습니다.")
     else:
-        client = OpenAI(api_key=api_key) # 최신 버전 객체 선언
+        client = get_openai_client(api_key)
+        
+        # 입력(사용자/달성률/일기)이 직전 결과와 같으면 카드를 다시 뽑지 않음
+        # → 같은 내용으로 다시 제출(더블클릭 포함)해도 cache_key가 같아 API를 재호출하지 않음
+        inputs = (st.session_state.user_info, progress, reflection[:REFLECTION_MAX_CHARS])
+        last = st.session_state.analysis_result
+        if last and last["inputs"] == inputs and time.time() - last["ts"] < AI_CACHE_TTL:
+            card_drawn = last["card"]
+        else:
+            card_drawn = st.session_state.rng.choice(TAROT_CARDS)
         
-        with st.spinner("운명의 카드를 뽑는 중..."):
-            # Tarot API 시뮬레이션 (공용 API는 불안정한 경우가 많아 78장 로직 내장 권장)
-            # 여기서는 예시로 고퀄리티 타로 데이터 사용
-            cards = ["The Fool", "The Magician", "The High Priestess", "The Empress", "The Lovers", "Strength"]
-            card_drawn = random.choice(cards)
+        # GPT-4o 호출 (최신 문법, 동일 입력은 세션 캐시에서 반환)
+        cache_key = (
+            "gpt-4o",
+            COACH_SYSTEM_PROMPT,
+            build_coach_prompt(st.session_state.user_info, progress, reflection, card_drawn)
+        )
+        
+        try:
+            c1, c2 = show_analysis(card_drawn)
+            with c2:
+                truncated = False
+                cached = st.session_state.ai_cache.get(cache_key)
+                if cached is None or time.time() - cached[0] > AI_CACHE_TTL:
+                    # 첫 토큰이 올 때까지(요청 전송 + TTFT, 재시도 포함)는 스피너로 대기 표시
+                    status = {}
+                    stream = stream_coaching(client, *cache_key, status)
+                    with st.spinner("운명의 카드를 해석하는 중..."):
+                        first = next(stream, "")
+                    coaching = st.write_stream(itertools.chain([first], stream))
+                    # 토큰 상한에 걸려 잘린 답변은 캐시하지 않음 (다시 요청하면 새로 생성)
+                    truncated = status.get("finish_reason") == "length"
+                    if truncated:
+                        st.caption("답변이 길어 중간에 끊겼어요. 다시 시도해 주세요.")
+                    else:
+                        remember_coaching(cache_key, coaching)
+                        st.balloons()  # 새로 생성된 응답일 때만 (캐시 재표시에는 애니메이션 생략)
+                else:
+                    coaching = cached[1]
+                    st.write(coaching)
+            # 이미지 다운로드는 스트리밍이 끝난 뒤에 (첫 토큰을 늦추지 않도록)
+            c1.image(card_image(card_drawn))
+            # 마지막 결과는 세션에 보관 → 이후 다른 위젯 rerun에서도 API 재호출 없이 다시 표시
+            # 잘린 답변이면 이전 결과도 비움 (다음 rerun에서 예전 카드/일기의 결과로 바뀌어 보이지 않도록)
+            if truncated:
+                st.session_state.analysis_result = None
+            else:
+                st.session_state.analysis_result = {"card": card_drawn, "text": coaching, "inputs": inputs, "ts": time.time()}
             
-            try:
-                # GPT-4o 호출 (최신 문법)
-                response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": "당신은 iOS 감성의 따뜻하고 세련된 라이프 코치입니다."},
-                        {"role": "user", "content": f"""
-                            사용자 정보: {st.session_state.user_info}
-                            습관 달성률: {progress*100}%
-                            오늘의 일기: {reflection}
-                            뽑은 타로 카드: {card_drawn}
-                            
-                            1. 타로 카드의 의미를 오늘 하루와 연결해줘.
-                            2. 칭찬과 함께 내일 더 잘할 수 있는 다정한 조언을 해줘.
-                            3. 아주 심플하고 간결하게 애플 스타일로 답변해줘.
-                        """}
-                    ]
-                )
-                
-                # 결과 출력
-                st.divider()
-                c1, c2 = st.columns([1, 2])
-                with c1:
-                    st.markdown(f"### 🃏 Tarot\n**{card_drawn}**")
-                    st.image(f"https://www.trustedtarot.com/img/cards/{card_drawn.lower().replace(' ', '-')}.png")
-                with c2:
-                    st.markdown("### 🕊️ AI Coach")
-                    st.write(response.choices[0].message.content)
-                st.balloons()
-                
-            except Exception as e:
-                st.error(f"AI 분석 중 오류가 발생했습니다: {e}")
+        except Exception as e:
+            st.error(f"AI 분석 중 오류가 발생했습니다: {e}")
+elif st.session_state.analysis_result and time.time() - st.session_state.analysis_result["ts"] < AI_CACHE_TTL:
+    result = st.session_state.analysis_result
+    c1, c2 = show_analysis(result["card"])
+    c2.write(result["text"])
+    c1.image(card_image(result["card"]))